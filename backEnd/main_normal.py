@@ -1,21 +1,39 @@
 import io
 import os
+import re
+import asyncio
+import time
 import uuid
-import json
+import hashlib
+import threading
 import traceback
+import httpx
+import aiofiles
+import aiofiles.os
+import orjson
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 
 from fastapi import FastAPI, File, UploadFile, Form
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from groq import Groq
+from groq import AsyncGroq
 from gtts import gTTS
 
 # --- NEW IMPORTS for Personalized Voice ---
 from TTS.api import TTS
 from speechbrain.pretrained import SpeakerRecognition
 # torchaudio is a dependency for speechbrain, good to have it explicit
+import torch
 import torchaudio 
+from torchaudio.io import StreamReader
+
+# Optional: serves the ECAPA embedding model through ONNX Runtime when installed
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
 
 # --- START OF API CONFIGURATION ---
 
@@ -30,72 +48,261 @@ groq_api_key = os.getenv("GROQ_API_KEY")
 if not groq_api_key:
     print("❌ GROQ_API_KEY not found in .env file. Exiting.")
     exit()
-groq_client = Groq(api_key=groq_api_key)
+# One pooled HTTP/2 client per worker, so Whisper uploads and chat completions reuse
+# the same TLS connection instead of handshaking on every request
+groq_client = AsyncGroq(
+    api_key=groq_api_key,
+    http_client=httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=60),
+        timeout=60,
+    ),
+)
 groq_chat_model = "meta-llama/llama-4-scout-17b-16e-instruct" 
 
 # --- System Prompts for Different Tasks ---
-SYSTEM_PROMPTS = {
+# Task instructions only. The answer format is added separately, because a single
+# transcript and a batch of transcripts expect differently shaped JSON.
+PROMPT_INSTRUCTIONS = {
     "summarizer": (
         "Kamu adalah summarizer ekstrim teks transkrip bahasa Indonesia. Hanya intinya saja, jangan menuliskan ulang semuanya, maksimal 5 kata. "
         "Tugasmu adalah membaca teks transkrip lalu menghasilkan SATU kalimat ringkas yang alami dan mewakili maksud utama dari transkrip tersebut. "
         "Gunakan kata-kata yang wajar digunakan sehari-hari. "
         "Jangan memberi penjelasan, variasi, atau alternatif. "
         "Jangan menambahkan tanda baca kecuali tanda baca normal yang memang diperlukan. "
-        "Jawab HANYA dalam format JSON persis seperti ini: {\"natural_text\": \"<hasil kamu>\"} "
-        "Tanpa teks tambahan, tanpa catatan, dan tanpa field lain."
     )
 }
 
+SINGLE_OUTPUT_FORMAT = (
+    "Jawab HANYA dalam format JSON persis seperti ini: {\"natural_text\": \"<hasil kamu>\"} "
+    "Tanpa teks tambahan, tanpa catatan, dan tanpa field lain."
+)
+
+SYSTEM_PROMPTS = {key: instructions + SINGLE_OUTPUT_FORMAT for key, instructions in PROMPT_INSTRUCTIONS.items()}
+
+# Output word limit per prompt; a transcription already within it is used as-is without the LLM
+PROMPT_MAX_WORDS = {
+    "summarizer": 5,
+}
+
+# Everything before the transcript is fixed, so it is built once instead of per request
+SYSTEM_PROMPT_PREFIXES = {
+    key: f"{prompt}\n\nTeks transkrip pengguna: \"" for key, prompt in SYSTEM_PROMPTS.items()
+}
+
 # --- NEW: Speaker Verification & Personalized TTS Setup ---
 
-# This flag will be updated by the speaker verification logic
-isMe = False
+# This is the reference audio of your voice.
+# IMPORTANT: Record yourself saying a sentence and save it as "my_voice_reference.wav" in the same directory.
+MY_VOICE_REFERENCE = "my_voice_reference.wav"
+
+# ONNX export of the ECAPA embedding model, created on first start when onnxruntime is installed
+ECAPA_ONNX_PATH = "pretrained_models/spkrec-ecapa-voxceleb/embedding_model.onnx"
+# Int8 (dynamic quantization) copy of the ONNX model, used only if it agrees with the fp32 model
+ECAPA_INT8_ONNX_PATH = "pretrained_models/spkrec-ecapa-voxceleb/embedding_model.int8.onnx"
+ECAPA_INT8_ENABLED = os.getenv("ECAPA_INT8", "1") == "1"
+# Minimum cosine between embeddings of the reference voice before a faster ECAPA model
+# (ONNX Runtime, then int8) replaces the one it was checked against
+ECAPA_MIN_AGREEMENT = 0.99
+
+# ECAPA works on mono 16 kHz audio
+SPEAKER_SAMPLE_RATE = 16000
+
+# ECAPA's usual cosine threshold, the same default SpeakerRecognition.verify_files uses
+SPEAKER_SCORE_THRESHOLD = 0.25
+
+# IMPORTANT: These paths assume you have run the training script and the model exists in 'my_trained_model/'.
+personalized_model_config = "my_trained_model/config.json"
+personalized_model_file = "my_trained_model/best_model.pth"
+# Personalized synthesis is the most expensive step, so it runs on the GPU in fp16 when one is available
+personalized_tts_device = "cuda" if torch.cuda.is_available() else "cpu"
+# Int8 Linear layers for CPU synthesis; opt-in because voice quality has to be checked by ear
+PERSONALIZED_TTS_INT8 = os.getenv("PERSONALIZED_TTS_INT8", "0") == "1"
+
+# Each Uvicorn worker is its own process, so the CPU cores are split between them. A worker
+# can't see a `--workers` flag, so the count comes from UVICORN_WORKERS (exported by __main__
+# below) or WEB_CONCURRENCY (uvicorn's own default for --workers); a bare `uvicorn` run is one worker.
+UVICORN_WORKERS = int(os.getenv("UVICORN_WORKERS") or os.getenv("WEB_CONCURRENCY") or "1")
+
+# Loaded by the FastAPI lifespan, once per worker
+speaker_verifier = None
+personalized_tts = None
+# Embedding of MY_VOICE_REFERENCE, computed once so each request only embeds the candidate
+my_voice_embedding = None
+ecapa_session = None
+
+def configure_torch():
+    """
+    Sets up PyTorch for CPU inference: oneDNN kernels and one intra-op pool per worker.
+    """
+    torch.backends.mkldnn.enabled = True
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // UVICORN_WORKERS))
+    torch.set_num_interop_threads(1)
 
-try:
-    # --- Speaker Verification Setup ---
-    print("🔊 Loading Speaker Verification model...")
-    speaker_verifier = SpeakerRecognition.from_hparams(
-        source="speechbrain/spkrec-ecapa-voxceleb", 
-        savedir="pretrained_models/spkrec-ecapa-voxceleb"
-    )
-    print("✅ Speaker Verification model loaded.")
-
-    # This is the reference audio of your voice.
-    # IMPORTANT: Record yourself saying a sentence and save it as "my_voice_reference.wav" in the same directory.
-    MY_VOICE_REFERENCE = "my_voice_reference.wav"
-    if not os.path.exists(MY_VOICE_REFERENCE):
-        print(f"❌ WARNING: Voice reference file not found at '{MY_VOICE_REFERENCE}'. Speaker verification will fail.")
-
-
-    # --- Personalized TTS Model Setup ---
-    # IMPORTANT: These paths assume you have run the training script and the model exists in 'my_trained_model/'.
-    personalized_model_config = "my_trained_model/config.json"
-    personalized_model_file = "my_trained_model/best_model.pth"
-    
-    if os.path.exists(personalized_model_config) and os.path.exists(personalized_model_file):
-        print("🔊 Loading Personalized TTS model...")
-        personalized_tts = TTS(
-            model_path=personalized_model_file,
-            config_path=personalized_model_config,
-            progress_bar=False,
-            gpu=False # Set to True if you have a GPU and compatible PyTorch
+def load_ecapa_session():
+    """
+    Exports the ECAPA embedding model to ONNX (once) and opens an ONNX Runtime session for it.
+    Feature extraction stays in PyTorch; only the embedding network runs in ONNX Runtime.
+    """
+    if not os.path.exists(ECAPA_ONNX_PATH):
+        print("📦 Exporting ECAPA embedding model to ONNX...")
+        dummy_feats = torch.randn(1, 200, 80)
+        # Every worker may export at startup, so write to a private name and rename into place
+        temp_path = f"{ECAPA_ONNX_PATH}.{uuid.uuid4().hex}.tmp"
+        torch.onnx.export(
+            speaker_verifier.mods.embedding_model,
+            dummy_feats,
+            temp_path,
+            opset_version=17,
+            input_names=["feats"],
+            output_names=["embedding"],
+            dynamic_axes={"feats": {0: "batch", 1: "frames"}, "embedding": {0: "batch"}},
         )
-        print("✅ Personalized TTS model loaded.")
-    else:
-        personalized_tts = None
-        print("❌ WARNING: Personalized TTS model not found. The 'personalized' option will not work.")
+        os.replace(temp_path, ECAPA_ONNX_PATH)
+    return _open_ort_session(ECAPA_ONNX_PATH)
 
-except Exception as e:
-    print(f"❌ Critical error during model loading: {e}")
-    print("   The application might not function correctly for personalized voice features.")
+def load_ecapa_int8_session():
+    """
+    Quantizes the exported ECAPA model to int8 (once) and opens a session for it.
+    ECAPA is almost entirely Conv1d, which ONNX Runtime quantizes but PyTorch's dynamic quantization doesn't.
+    """
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    if not os.path.exists(ECAPA_INT8_ONNX_PATH):
+        print("📦 Quantizing ECAPA embedding model to int8...")
+        temp_path = f"{ECAPA_INT8_ONNX_PATH}.{uuid.uuid4().hex}.tmp"
+        quantize_dynamic(ECAPA_ONNX_PATH, temp_path, weight_type=QuantType.QInt8)
+        os.replace(temp_path, ECAPA_INT8_ONNX_PATH)
+    return _open_ort_session(ECAPA_INT8_ONNX_PATH)
+
+def _open_ort_session(path: str):
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = torch.get_num_threads()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return ort.InferenceSession(path, sess_options=options, providers=["CPUExecutionProvider"])
+
+def _embed_voice_torch(signal):
+    with torch.inference_mode():
+        return speaker_verifier.encode_batch(signal.unsqueeze(0)).squeeze()
+
+def _embed_voice_onnx(signal, session):
+    with torch.inference_mode():
+        # Same preprocessing as SpeakerRecognition.encode_batch
+        wavs = signal.unsqueeze(0).float()
+        feats = speaker_verifier.mods.compute_features(wavs)
+        feats = speaker_verifier.mods.mean_var_norm(feats, torch.ones(1))
+    embedding = session.run(None, {"feats": feats.numpy()})[0]
+    return torch.from_numpy(embedding).squeeze()
+
+def embed_voice(signal):
+    """
+    Returns the speaker embedding of a mono 16 kHz waveform.
+    """
+    if ecapa_session is not None:
+        try:
+            return _embed_voice_onnx(signal, ecapa_session)
+        except Exception as e:
+            # The session was checked against PyTorch at startup, so its embeddings are interchangeable
+            print(f"⚠️ Warning: ONNX Runtime embedding failed, using PyTorch: {e}")
+    return _embed_voice_torch(signal)
+
+def load_models():
+    global speaker_verifier, personalized_tts, my_voice_embedding, ecapa_session
+    try:
+        # --- Speaker Verification Setup ---
+        print("🔊 Loading Speaker Verification model...")
+        speaker_verifier = SpeakerRecognition.from_hparams(
+            source="speechbrain/spkrec-ecapa-voxceleb", 
+            savedir="pretrained_models/spkrec-ecapa-voxceleb"
+        )
+        speaker_verifier.mods.eval()
+        print("✅ Speaker Verification model loaded.")
+
+        ecapa_session = None
+        if os.path.exists(MY_VOICE_REFERENCE):
+            reference_signal = speaker_verifier.load_audio(MY_VOICE_REFERENCE)
+            my_voice_embedding = _embed_voice_torch(reference_signal)
+            print("✅ Voice reference embedding cached.")
+
+            if ort is not None:
+                try:
+                    onnx_session = load_ecapa_session()
+                    onnx_embedding = _embed_voice_onnx(reference_signal, onnx_session)
+                    agreement = torch.nn.functional.cosine_similarity(my_voice_embedding, onnx_embedding, dim=-1).item()
+                    if agreement >= ECAPA_MIN_AGREEMENT:
+                        ecapa_session = onnx_session
+                        my_voice_embedding = onnx_embedding
+                        print(f"✅ ECAPA embedding model running on ONNX Runtime (agreement with PyTorch: {agreement:.4f}).")
+                    else:
+                        print(f"⚠️ Warning: ONNX ECAPA model drifts from PyTorch ({agreement:.4f}). Using PyTorch.")
+                except Exception as e:
+                    print(f"⚠️ Warning: ONNX Runtime unavailable for ECAPA, using PyTorch: {e}")
+
+            if ecapa_session is not None and ECAPA_INT8_ENABLED:
+                try:
+                    int8_session = load_ecapa_int8_session()
+                    int8_embedding = _embed_voice_onnx(reference_signal, int8_session)
+                    agreement = torch.nn.functional.cosine_similarity(my_voice_embedding, int8_embedding, dim=-1).item()
+                    if agreement >= ECAPA_MIN_AGREEMENT:
+                        ecapa_session = int8_session
+                        my_voice_embedding = int8_embedding
+                        print(f"✅ Using int8 ECAPA model (agreement with fp32: {agreement:.4f}).")
+                    else:
+                        print(f"⚠️ Warning: int8 ECAPA model drifts from fp32 ({agreement:.4f}). Keeping fp32.")
+                except Exception as e:
+                    print(f"⚠️ Warning: Could not quantize ECAPA model, keeping fp32: {e}")
+        else:
+            print(f"❌ WARNING: Voice reference file not found at '{MY_VOICE_REFERENCE}'. Speaker verification will fail.")
+
+
+        # --- Personalized TTS Model Setup ---
+        if os.path.exists(personalized_model_config) and os.path.exists(personalized_model_file):
+            print("🔊 Loading Personalized TTS model...")
+            personalized_tts = TTS(
+                model_path=personalized_model_file,
+                config_path=personalized_model_config,
+                progress_bar=False,
+            ).to(personalized_tts_device)
+            personalized_tts.synthesizer.tts_model.eval()
+            if personalized_tts.synthesizer.vocoder_model is not None:
+                personalized_tts.synthesizer.vocoder_model.eval()
+            if PERSONALIZED_TTS_INT8 and personalized_tts_device == "cpu":
+                torch.ao.quantization.quantize_dynamic(
+                    personalized_tts.synthesizer.tts_model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+                )
+                print("✅ Personalized TTS Linear layers quantized to int8.")
+            print(f"✅ Personalized TTS model loaded on {personalized_tts_device}.")
+        else:
+            personalized_tts = None
+            print("❌ WARNING: Personalized TTS model not found. The 'personalized' option will not work.")
+
+    except Exception as e:
+        print(f"❌ Critical error during model loading: {e}")
+        print("   The application might not function correctly for personalized voice features.")
+        speaker_verifier = None
+        personalized_tts = None
+        my_voice_embedding = None
+        ecapa_session = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global speaker_verifier, personalized_tts, my_voice_embedding, ecapa_session
+    configure_torch()
+    load_models()
+    threading.Thread(target=_response_cache_janitor, name="response-cache-janitor", daemon=True).start()
+    llm_batcher.start()
+    yield
+    await llm_batcher.stop()
+    await groq_client.close()
     speaker_verifier = None
     personalized_tts = None
+    my_voice_embedding = None
+    ecapa_session = None
 
 
 # --- END OF API CONFIGURATION ---
 
 # --- FastAPI App ---
-app = FastAPI()
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # --- CORS CONFIGURATION ---
 origins = ["*"]
@@ -107,35 +314,255 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# --- Audio Config ---
-latest_summary_audio_path = None
-latest_transcription_audio_path = None
+# --- Upload Config ---
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# --- Transcription / LLM Cache ---
+# Retried uploads of the same recording skip Whisper, and the summarizer runs at
+# temperature 0, so its output for a given transcription can be reused too.
+TRANSCRIPTION_CACHE_SIZE = 256
+NATURAL_TEXT_CACHE_SIZE = 1024
+
+class LRUCache:
+    """
+    Small in-memory mapping that drops the least recently used entry when full.
+    """
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        if key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+transcription_cache = LRUCache(TRANSCRIPTION_CACHE_SIZE)
+natural_text_cache = LRUCache(NATURAL_TEXT_CACHE_SIZE)
+
+def _hash_upload(file):
+    """
+    Hashes the spooled upload in chunks and rewinds it for the next reader.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    file.seek(0)
+    while chunk := file.read(UPLOAD_CHUNK_SIZE):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+# --- Download Config ---
+class AudioFileResponse(FileResponse):
+    """
+    FileResponse with the audio media type and cache headers for a generated response.
+    Streaming, sendfile and Range requests from audio players are handled by FileResponse itself.
+    """
+    def __init__(self, path: str, filename: str):
+        # Determine media type based on file extension
+        media_type = "audio/wav" if path.endswith(".wav") else "audio/mpeg"
+        super().__init__(
+            path,
+            media_type=media_type,
+            filename=filename,
+            headers={"Cache-Control": AUDIO_RESPONSE_CACHE_CONTROL},
+        )
+
+# --- TTS Response Cache ---
+# Synthesized speech is stored under a hash of (voice, text), so a repeated phrase
+# is served straight from disk instead of being synthesized again.
+RESPONSES_DIR = "responses"
+RESPONSE_CACHE_TTL_SECONDS = 24 * 60 * 60
+RESPONSE_CACHE_MAX_BYTES = 200 * 1024 * 1024
+RESPONSE_CACHE_SWEEP_INTERVAL_SECONDS = 10 * 60
+# Only content-addressed cache files are evicted; anything else in responses/ is left alone
+RESPONSE_CACHE_FILE_PATTERN = re.compile(r"[0-9a-f]{64}\.(?:mp3|wav)")
+# Partial writes left behind by a synthesis that died before its rename
+RESPONSE_CACHE_TEMP_PATTERN = re.compile(r"[0-9a-f]{64}\.(?:mp3|wav)\.[0-9a-f]{32}\.tmp")
+
+os.makedirs(RESPONSES_DIR, exist_ok=True)
+
+# --- Response Tokens ---
+# Each /process_audio call gets its own token pointing at its audio files. Tokens are
+# stored on disk because each Uvicorn worker is a separate process.
+RESPONSE_TOKENS_DIR = os.path.join(RESPONSES_DIR, "tokens")
+RESPONSE_TOKEN_TTL_SECONDS = 60 * 60
+RESPONSE_TOKEN_PATTERN = re.compile(r"[0-9a-f]{32}")
+# The audio behind a token never changes, so clients may keep it for the token's lifetime
+AUDIO_RESPONSE_CACHE_CONTROL = f"public, max-age={RESPONSE_TOKEN_TTL_SECONDS}, immutable"
+
+os.makedirs(RESPONSE_TOKENS_DIR, exist_ok=True)
+
+# In-flight syntheses by cache key, so concurrent identical requests share one job
+_tts_inflight = {}
+
+def _tts_cache_key(text: str, voice: str):
+    return hashlib.sha256(f"{voice}\0{text}".encode()).hexdigest()
+
+def _cached_speech_file(key: str, extension: str, synthesize):
+    """
+    Returns the cached speech file for `key`, calling `synthesize(path)` only on a cache miss.
+    """
+    speech_file = os.path.join(RESPONSES_DIR, f"{key}{extension}")
+    if os.path.exists(speech_file):
+        # Touch the file so the eviction sweep treats it as recently used
+        os.utime(speech_file)
+        print(f"♻️ Reusing cached speech: {speech_file}")
+        return speech_file
+    # Write to a temporary name first so a half-written file is never served
+    temp_file = f"{speech_file}.{uuid.uuid4().hex}.tmp"
+    try:
+        synthesize(temp_file)
+        os.replace(temp_file, speech_file)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+    return speech_file
+
+def _coalesced_tts(key: str, speak, *args):
+    """
+    Runs `speak(*args)` in a worker thread, or joins the job already running for `key`.
+    """
+    task = _tts_inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(asyncio.to_thread(speak, *args))
+        _tts_inflight[key] = task
+        task.add_done_callback(lambda _: _tts_inflight.pop(key, None))
+    # Shield the shared job so one cancelled request doesn't cancel it for the others
+    return asyncio.shield(task)
+
+def _remove_cached_file(path):
+    # Every worker runs its own sweep, so another process may have removed the file already
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def _evict_response_cache():
+    """
+    Removes cached responses older than the TTL, then the least recently used ones
+    until the cache fits in RESPONSE_CACHE_MAX_BYTES. Stale partial writes are removed too.
+    """
+    now = time.time()
+    entries = []
+    for entry in os.scandir(RESPONSES_DIR):
+        if not entry.is_file():
+            continue
+        is_temp = RESPONSE_CACHE_TEMP_PATTERN.fullmatch(entry.name) is not None
+        if not is_temp and RESPONSE_CACHE_FILE_PATTERN.fullmatch(entry.name) is None:
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        if is_temp:
+            # A live synthesis renames its temp file long before a sweep interval passes
+            if now - stat.st_mtime > RESPONSE_CACHE_SWEEP_INTERVAL_SECONDS:
+                _remove_cached_file(entry.path)
+            continue
+        if now - stat.st_mtime > RESPONSE_CACHE_TTL_SECONDS:
+            _remove_cached_file(entry.path)
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= RESPONSE_CACHE_MAX_BYTES:
+            break
+        _remove_cached_file(path)
+        total_size -= size
+
+def _evict_response_tokens():
+    """
+    Removes expired response tokens and partial writes older than the token TTL. The audio
+    they point at is shared through the TTS cache, so it is left to the cache eviction.
+    """
+    now = time.time()
+    for entry in os.scandir(RESPONSE_TOKENS_DIR):
+        if not entry.name.endswith((".json", ".json.tmp")):
+            continue
+        try:
+            if now - entry.stat().st_mtime > RESPONSE_TOKEN_TTL_SECONDS:
+                _remove_cached_file(entry.path)
+        except FileNotFoundError:
+            continue
+
+def _response_cache_janitor():
+    while True:
+        try:
+            _evict_response_cache()
+            _evict_response_tokens()
+        except Exception as e:
+            print(f"⚠️ Warning: Response cache eviction failed: {e}")
+        time.sleep(RESPONSE_CACHE_SWEEP_INTERVAL_SECONDS)
+
+# Token files are read and written from request handlers, so they go through aiofiles
+# to keep disk I/O off the event loop thread
+async def _save_response_token(summary_path, transcription_path):
+    token = uuid.uuid4().hex
+    token_file = os.path.join(RESPONSE_TOKENS_DIR, f"{token}.json")
+    temp_file = f"{token_file}.tmp"
+    async with aiofiles.open(temp_file, "wb") as f:
+        await f.write(orjson.dumps({
+            "summary": summary_path,
+            "transcription": transcription_path,
+            "expires_at": time.time() + RESPONSE_TOKEN_TTL_SECONDS,
+        }))
+    await aiofiles.os.replace(temp_file, token_file)
+    return token
+
+async def _load_response_token(token: str):
+    # The token becomes part of a path, so only accept what _save_response_token generates
+    if not RESPONSE_TOKEN_PATTERN.fullmatch(token):
+        return {}
+    try:
+        async with aiofiles.open(os.path.join(RESPONSE_TOKENS_DIR, f"{token}.json"), "rb") as f:
+            entry = orjson.loads(await f.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return {}
+    if entry["expires_at"] < time.time():
+        return {}
+    return entry
 
 # --- NEW: Speaker Verification Function ---
-def verify_speaker(audio_file_path: str):
+def decode_upload(file):
     """
-    Verifies if the speaker in the audio file matches the reference voice.
+    Decodes an uploaded (e.g. webm) file object straight into a mono 16 kHz waveform, without a temp file.
     """
-    global isMe
-    if not speaker_verifier or not os.path.exists(MY_VOICE_REFERENCE):
+    file.seek(0)
+    reader = StreamReader(file)
+    reader.add_basic_audio_stream(
+        frames_per_chunk=SPEAKER_SAMPLE_RATE, sample_rate=SPEAKER_SAMPLE_RATE, num_channels=1
+    )
+    chunks = [chunk for (chunk,) in reader.stream()]
+    file.seek(0)
+    # Chunks are (frames, channels)
+    return torch.cat(chunks)[:, 0]
+
+def verify_speaker(audio_file):
+    """
+    Verifies if the speaker in the uploaded audio file object matches the reference voice.
+    """
+    if not speaker_verifier or my_voice_embedding is None:
         print("❌ Cannot perform speaker verification. Model or reference file is missing.")
-        isMe = False
         return False
     try:
-        score_threshold = 0.5 
-        score, prediction = speaker_verifier.verify_files(MY_VOICE_REFERENCE, audio_file_path)
-        print(f"🎤 Speaker verification score: {score[0]:.2f} (Threshold: {score_threshold})")
-        if prediction[0]:
+        candidate_embedding = embed_voice(decode_upload(audio_file))
+        score = torch.nn.functional.cosine_similarity(my_voice_embedding, candidate_embedding, dim=-1).item()
+        print(f"🎤 Speaker verification score: {score:.2f} (Threshold: {SPEAKER_SCORE_THRESHOLD})")
+        if score > SPEAKER_SCORE_THRESHOLD:
             print("✅ Speaker VERIFIED.")
-            isMe = True
             return True
         else:
             print("❌ Speaker REJECTED.")
-            isMe = False
             return False
     except Exception as e:
         print(f"❌ Error during speaker verification: {e}")
-        isMe = False
         return False
 
 # --- NEW: Personalized Speech Synthesis Function ---
@@ -150,36 +577,187 @@ def speak_text_to_file_personalized(text: str):
         if not text or not text.strip():
             print("⚠️ Warning: Attempted to generate personalized speech from empty text.")
             return None
-        filename = f"response_{uuid.uuid4()}.wav" # Coqui TTS outputs wav
-        os.makedirs("responses", exist_ok=True)
-        speech_file = os.path.join("responses", filename)
-        personalized_tts.tts_to_file(text=text, file_path=speech_file)
-        return speech_file
+        key = _tts_cache_key(text, "personalized")
+        # Coqui TTS outputs wav
+        def synthesize(path):
+            with torch.inference_mode(), torch.autocast(
+                "cuda", dtype=torch.float16, enabled=personalized_tts_device == "cuda"
+            ):
+                personalized_tts.tts_to_file(text=text, file_path=path)
+        return _cached_speech_file(key, ".wav", synthesize)
     except Exception as e:
         print(f"❌ Failed to generate personalized speech: {e}")
         return None
 
-# --- Existing Functions (Unchanged) ---
-def translate_to_natural_sound_with_groq(transcription: str, prompt_selection: str):
-    if prompt_selection not in SYSTEM_PROMPTS:
-        print(f"⚠️ Warning: Invalid prompt selection '{prompt_selection}'. Defaulting to 'summarizer'.")
-        prompt_selection = "summarizer"
-    base_prompt = SYSTEM_PROMPTS[prompt_selection]
-    system_prompt = f"{base_prompt}\n\nTeks transkrip pengguna: \"{transcription}\""
-    print(f"🧠 Using prompt key: '{prompt_selection}'")
+# --- Chat Completion Micro-Batching ---
+# Requests that arrive within a few milliseconds of each other share one Groq completion.
+LLM_BATCH_MAX_SIZE = 8
+LLM_BATCH_MAX_WAIT_SECONDS = 0.02
+
+# Replaces SINGLE_OUTPUT_FORMAT for batches, so the prompt asks for only one JSON shape
+BATCH_OUTPUT_FORMAT = (
+    "Kamu akan menerima beberapa teks transkrip sekaligus dalam bentuk JSON, masing-masing dengan \"id\". "
+    "Proses setiap transkrip secara terpisah dengan aturan di atas. "
+    "Jawab HANYA dalam format JSON persis seperti ini: "
+    "{\"results\": [{\"id\": <id>, \"natural_text\": \"<hasil kamu>\"}]} "
+    "dengan tepat satu elemen untuk setiap transkrip. "
+    "Tanpa teks tambahan, tanpa catatan, dan tanpa field lain."
+)
+BATCH_SYSTEM_PROMPTS = {
+    key: instructions + BATCH_OUTPUT_FORMAT for key, instructions in PROMPT_INSTRUCTIONS.items()
+}
+
+def _valid_natural_text(answer):
+    """
+    Returns the natural_text of a parsed model answer, or None if it is not a string.
+    """
+    # A bare string or a null natural_text would be cached and then fail in process_audio or TTS
+    if isinstance(answer, dict) and isinstance(answer.get("natural_text"), str):
+        return answer["natural_text"]
+    return None
+
+async def _complete_natural_text(transcription: str, prompt_selection: str):
+    system_prompt = SYSTEM_PROMPT_PREFIXES[prompt_selection] + transcription + "\""
+    completion = await groq_client.chat.completions.create(
+        model=groq_chat_model,
+        messages=[{"role": "system", "content": system_prompt}],
+        temperature=0.0,
+        max_tokens=100
+    )
+    response_text = completion.choices[0].message.content.strip()
     try:
-        completion = groq_client.chat.completions.create(
+        natural_text = _valid_natural_text(orjson.loads(response_text))
+    except orjson.JSONDecodeError:
+        natural_text = None
+    if natural_text is None:
+        print(f"⚠️ Warning: Groq response was not the expected JSON. Response: {response_text}")
+        return {"natural_text": response_text}
+    return {"natural_text": natural_text}
+
+async def _complete_natural_text_batch(transcriptions: list, prompt_selection: str):
+    """
+    Processes several transcriptions with one completion, falling back to one call
+    per transcription if the batched call fails or its answer can't be matched back
+    to its inputs. Returns one result or exception per transcription.
+    """
+    system_prompt = BATCH_SYSTEM_PROMPTS[prompt_selection]
+    inputs = [{"id": i, "transkrip": text} for i, text in enumerate(transcriptions)]
+    try:
+        completion = await groq_client.chat.completions.create(
             model=groq_chat_model,
-            messages=[{"role": "system", "content": system_prompt}],
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": orjson.dumps(inputs).decode()},
+            ],
             temperature=0.0,
-            max_tokens=100
+            max_tokens=100 * len(transcriptions)
         )
         response_text = completion.choices[0].message.content.strip()
+        results = {item["id"]: _valid_natural_text(item) for item in orjson.loads(response_text)["results"]}
+        natural_texts = [results[i] for i in range(len(transcriptions))]
+        if any(text is None for text in natural_texts):
+            raise TypeError("natural_text is not a string")
+        return [{"natural_text": text} for text in natural_texts]
+    except Exception as e:
+        print(f"⚠️ Warning: Batched Groq call failed ({e}). Retrying one by one.")
+        # Each retry succeeds or fails for its own request only
+        return await asyncio.gather(*(
+            _complete_natural_text(text, prompt_selection) for text in transcriptions
+        ), return_exceptions=True)
+
+class MicroBatcher:
+    """
+    Collects chat-completion jobs for up to `max_wait` seconds and sends them to Groq together.
+    """
+    def __init__(self, max_size: int, max_wait: float):
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self._queue = None
+        self._worker = None
+        self._dispatches = set()
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._worker.cancel()
         try:
-            return json.loads(response_text)
-        except json.JSONDecodeError:
-            print(f"⚠️ Warning: Groq response was not valid JSON. Response: {response_text}")
-            return {"natural_text": response_text}
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+
+    async def submit(self, transcription: str, prompt_selection: str):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((transcription, prompt_selection, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            # A single completion can only use one system prompt
+            jobs_by_prompt = {}
+            for job in batch:
+                jobs_by_prompt.setdefault(job[1], []).append(job)
+            for prompt_selection, jobs in jobs_by_prompt.items():
+                task = asyncio.create_task(self._dispatch(prompt_selection, jobs))
+                self._dispatches.add(task)
+                task.add_done_callback(self._dispatches.discard)
+
+    async def _dispatch(self, prompt_selection: str, jobs: list):
+        futures = [future for _, _, future in jobs]
+        try:
+            if len(jobs) == 1:
+                results = [await _complete_natural_text(jobs[0][0], prompt_selection)]
+            else:
+                print(f"📦 Batching {len(jobs)} '{prompt_selection}' requests into one Groq call.")
+                results = await _complete_natural_text_batch([text for text, _, _ in jobs], prompt_selection)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, result in zip(futures, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+llm_batcher = MicroBatcher(LLM_BATCH_MAX_SIZE, LLM_BATCH_MAX_WAIT_SECONDS)
+
+# --- Existing Functions (Unchanged) ---
+def normalize_prompt_selection(prompt_selection: str):
+    if prompt_selection not in SYSTEM_PROMPTS:
+        print(f"⚠️ Warning: Invalid prompt selection '{prompt_selection}'. Defaulting to 'summarizer'.")
+        return "summarizer"
+    return prompt_selection
+
+async def translate_to_natural_sound_with_groq(transcription: str, prompt_selection: str):
+    prompt_selection = normalize_prompt_selection(prompt_selection)
+    cache_key = (prompt_selection, transcription)
+    cached = natural_text_cache.get(cache_key)
+    if cached is not None:
+        print(f"♻️ Reusing cached '{prompt_selection}' result.")
+        return cached
+    print(f"🧠 Using prompt key: '{prompt_selection}'")
+    try:
+        result = await llm_batcher.submit(transcription, prompt_selection)
+        if _valid_natural_text(result) is not None:
+            natural_text_cache.put(cache_key, result)
+        return result
     except Exception as e:
         print(f"❌ Error with Groq API: {e}")
         return {"natural_text": "I am sorry, I could not process the sound."}
@@ -189,16 +767,20 @@ def speak_text_to_file(text: str, lang: str = 'id'):
         if not text or not text.strip():
             print("⚠️ Warning: Attempted to generate speech from empty text.")
             return None
-        tts = gTTS(text=text, lang=lang, slow=False)
-        filename = f"response_{uuid.uuid4()}.mp3"
-        os.makedirs("responses", exist_ok=True)
-        speech_file = os.path.join("responses", filename)
-        tts.save(speech_file)
-        return speech_file
+        key = _tts_cache_key(text, lang)
+        return _cached_speech_file(
+            key, ".mp3", lambda path: gTTS(text=text, lang=lang, slow=False).save(path)
+        )
     except Exception as e:
         print(f"❌ Failed to generate speech: {e}")
         return None
 
+async def speak_text_to_file_async(text: str, lang: str = 'id'):
+    return await _coalesced_tts(_tts_cache_key(text, lang), speak_text_to_file, text, lang)
+
+async def speak_text_to_file_personalized_async(text: str):
+    return await _coalesced_tts(_tts_cache_key(text, "personalized"), speak_text_to_file_personalized, text)
+
 # --- API Endpoints ---
 
 # --- UPDATED /process_audio Endpoint ---
@@ -208,76 +790,103 @@ async def process_audio(
     model_selection: str = Form(...),
     prompt_selection: str = Form(...)
 ):
-    global latest_summary_audio_path, latest_transcription_audio_path
-
-    # Save the uploaded file temporarily for verification and transcription
-    temp_audio_path = f"temp_{uuid.uuid4()}.webm"
+    is_me = False
     try:
-        contents = await audio_file.read()
-        with open(temp_audio_path, "wb") as f:
-            f.write(contents)
-
         # --- SPEAKER VERIFICATION LOGIC ---
         if model_selection == "personalized":
             print("🕵️ 'Personalized' model selected. Running speaker verification...")
-            if not verify_speaker(temp_audio_path):
-                return JSONResponse(
+            is_me = await asyncio.to_thread(verify_speaker, audio_file.file)
+            if not is_me:
+                return ORJSONResponse(
                     status_code=403, # Forbidden
                     content={"message": "Speaker verification failed. You are not authorized to use this voice."}
                 )
 
         # --- Transcription ---
         print("🎤 Transcribing with Groq API (language: Indonesian)...")
-        transcription_response = groq_client.audio.transcriptions.create(
-            file=(audio_file.filename, contents), model=groq_whisper_model, language="id"
-        )
-        transcription = transcription_response.text
+        audio_hash = await asyncio.to_thread(_hash_upload, audio_file.file)
+        transcription = transcription_cache.get(audio_hash)
+        if transcription is not None:
+            print("♻️ Reusing cached transcription for identical audio.")
+        else:
+            # httpx reads file objects synchronously while streaming the multipart body, and
+            # uploads over 1 MB are spooled to disk, so UploadFile.read does it in a thread first
+            await audio_file.seek(0)
+            audio_bytes = await audio_file.read()
+            transcription_response = await groq_client.audio.transcriptions.create(
+                file=(audio_file.filename, audio_bytes), model=groq_whisper_model, language="id"
+            )
+            transcription = transcription_response.text.strip()
+            transcription_cache.put(audio_hash, transcription)
         print(f"Initial transcription: {transcription}")
         
         # --- Text Processing ---
-        natural_text_dict = translate_to_natural_sound_with_groq(transcription, prompt_selection)
+        # The summary and the transcription speech don't depend on each other, so the
+        # original transcription (always the standard voice) is synthesized while the LLM runs.
+        transcription_task = asyncio.create_task(speak_text_to_file_async(transcription, 'id'))
+        prompt_selection = normalize_prompt_selection(prompt_selection)
+        word_count = len(transcription.split())
+        max_words = PROMPT_MAX_WORDS.get(prompt_selection)
+        if max_words and 0 < word_count <= max_words:
+            # Already short enough, so the LLM would only repeat it. When the summary uses
+            # the normal voice it also shares the transcription's speech job and cached file.
+            print(f"⚡ Transcription has {word_count} word(s), skipping '{prompt_selection}' LLM call.")
+            natural_text_dict = {"natural_text": transcription}
+        else:
+            natural_text_dict = await translate_to_natural_sound_with_groq(transcription, prompt_selection)
         natural_text = natural_text_dict.get("natural_text", "Could not process text.")
         
         # --- DYNAMIC SPEECH SYNTHESIS ---
-        if model_selection == "personalized" and isMe:
+        # Synthesis runs in worker threads so it doesn't block the event loop
+        if is_me:
             print("🔊 Using PERSONALIZED voice for summary...")
-            latest_summary_audio_path = speak_text_to_file_personalized(natural_text)
+            summary_task = speak_text_to_file_personalized_async(natural_text)
         else:
             print("🔊 Using NORMAL voice (gTTS) for summary...")
-            latest_summary_audio_path = speak_text_to_file(natural_text, lang='id')
+            summary_task = speak_text_to_file_async(natural_text, 'id')
         
-        # Original transcription always uses the standard voice
-        latest_transcription_audio_path = speak_text_to_file(transcription, lang='id')
+        summary_audio_path, transcription_audio_path = await asyncio.gather(
+            summary_task, transcription_task
+        )
+        token = await _save_response_token(summary_audio_path, transcription_audio_path)
         
-        return JSONResponse(content={
+        return ORJSONResponse(content={
             "initial_transcription": transcription,
             "natural_text": natural_text,
+            "token": token,
         })
         
     except Exception as e:
         traceback.print_exc()
-        return JSONResponse(status_code=500, content={"message": f"An error occurred: {e}"})
-    finally:
-        # Clean up the temporary file
-        if os.path.exists(temp_audio_path):
-            os.remove(temp_audio_path)
+        return ORJSONResponse(status_code=500, content={"message": f"An error occurred: {e}"})
 
 
 @app.get("/get_response_audio")
-async def get_response_audio():
-    if latest_summary_audio_path and os.path.exists(latest_summary_audio_path):
-        # Determine media type based on file extension
-        media_type = "audio/wav" if latest_summary_audio_path.endswith(".wav") else "audio/mpeg"
-        return FileResponse(latest_summary_audio_path, media_type=media_type, filename="response.mp3")
-    return JSONResponse(status_code=404, content={"message": "Audio file not found."})
+async def get_response_audio(token: str = ""):
+    summary_audio_path = (await _load_response_token(token)).get("summary")
+    if summary_audio_path and await aiofiles.os.path.exists(summary_audio_path):
+        return AudioFileResponse(summary_audio_path, filename="response.mp3")
+    return ORJSONResponse(status_code=404, content={"message": "Audio file not found."})
 
 
 @app.get("/get_transcription_audio")
-async def get_transcription_audio():
-    if latest_transcription_audio_path and os.path.exists(latest_transcription_audio_path):
-        return FileResponse(latest_transcription_audio_path, media_type="audio/mpeg", filename="transcription.mp3")
-    return JSONResponse(status_code=404, content={"message": "Transcription audio file not found."})
+async def get_transcription_audio(token: str = ""):
+    transcription_audio_path = (await _load_response_token(token)).get("transcription")
+    if transcription_audio_path and await aiofiles.os.path.exists(transcription_audio_path):
+        return AudioFileResponse(transcription_audio_path, filename="transcription.mp3")
+    return ORJSONResponse(status_code=404, content={"message": "Transcription audio file not found."})
 
 if __name__ == '__main__':
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
+    workers = int(os.getenv("UVICORN_WORKERS") or os.getenv("WEB_CONCURRENCY") or "4")
+    # Workers are spawned fresh and read this back when they import the app
+    os.environ["UVICORN_WORKERS"] = str(workers)
+    # uvloop + httptools need the app as an import string to run multiple workers
+    uvicorn.run(
+        "main_normal:app",
+        host="0.0.0.0",
+        port=8001,
+        loop="uvloop",
+        http="httptools",
+        workers=workers,
+    )
\ No newline at end of file
@@ -1,17 +1,17 @@
 import numpy as np
 from resemblyzer import VoiceEncoder, preprocess_wav
 from pathlib import Path
-import librosa
 import soundfile as sf
+import subprocess
 import pyaudio
-import wave
 import threading
 import sys
 
 # --- 1. Persiapan Awal ---
 # Install library yang diperlukan:
 # pip install resemblyzer
-# pip install librosa soundfile pyaudio
+# pip install soundfile pyaudio
+# ffmpeg dipakai untuk MP3 (librosa hanya cadangan jika ffmpeg tidak ada)
 
 # Teks narasi untuk referensi
 narasi = """
@@ -24,6 +24,51 @@ Bahkan burung-burung pun terdiam saat dia lewat.
 # Nama file audio untuk enrollment (pendaftaran)
 nama_file_audio = "audio_saya.mp3"
 
+# File referensi yang dibandingkan dengan rekaman verifikasi.
+# Tambahkan rekaman lain di sini agar verifikasi lebih robust.
+file_enrollment = ["enrollment.wav"]
+
+# Sample rate hasil dekode ffmpeg (sama dengan yang dipakai Resemblyzer)
+FFMPEG_SAMPLE_RATE = 16000
+
+def muat_audio(path):
+    """
+    Memuat audio sebagai sinyal mono float32
+    
+    WAV/FLAC dibaca langsung dengan soundfile (libsndfile). Format lain seperti MP3
+    didekode lewat ffmpeg, dan librosa hanya dipakai jika ffmpeg tidak tersedia.
+    
+    Args:
+        path: Path file audio
+    
+    Returns:
+        Tuple (audio_data, sample_rate)
+    """
+    if not Path(path).exists():
+        raise FileNotFoundError(path)
+    
+    try:
+        audio_data, sample_rate = sf.read(path, dtype='float32', always_2d=False)
+    except RuntimeError:
+        try:
+            hasil = subprocess.run(
+                ["ffmpeg", "-v", "error", "-i", str(path),
+                 "-f", "s16le", "-ac", "1", "-ar", str(FFMPEG_SAMPLE_RATE), "-"],
+                capture_output=True,
+                check=True
+            )
+            audio_data = np.frombuffer(hasil.stdout, dtype=np.int16).astype(np.float32) / 32768.0
+            sample_rate = FFMPEG_SAMPLE_RATE
+        except (FileNotFoundError, subprocess.CalledProcessError):
+            import librosa
+            audio_data, sample_rate = librosa.load(path, sr=None, mono=True)
+    
+    # Gabungkan channel stereo menjadi mono
+    if audio_data.ndim > 1:
+        audio_data = audio_data.mean(axis=1)
+    
+    return audio_data, sample_rate
+
 print("🎙️  SISTEM VERIFIKASI SUARA DENGAN RESEMBLYZER")
 print("=" * 60)
 
@@ -31,8 +76,8 @@ print("=" * 60)
 try:
     print(f"\n📂 Memuat audio enrollment dari '{nama_file_audio}'...")
     
-    # Load audio menggunakan librosa (support MP3, WAV, dll)
-    audio_data, sample_rate = librosa.load(nama_file_audio, sr=None)
+    # Load audio (support MP3, WAV, dll)
+    audio_data, sample_rate = muat_audio(nama_file_audio)
     
     durasi_total = len(audio_data) / sample_rate
     print(f"✅ Audio berhasil dimuat!")
@@ -75,9 +120,12 @@ def rekam_audio(filename, durasi=10, sample_rate=16000):
         durasi: Durasi rekaman dalam detik
         sample_rate: Sample rate audio
     """
-    CHUNK = 1024
+    # Buffer besar = lebih sedikit pembacaan per detik
+    CHUNK = 4096
     FORMAT = pyaudio.paInt16
     CHANNELS = 1
+    # Update progress bar setiap N chunk, bukan setiap chunk
+    PROGRESS_SETIAP = 4
     
     p = pyaudio.PyAudio()
     
@@ -95,21 +143,26 @@ def rekam_audio(filename, durasi=10, sample_rate=16000):
         print(f"   Silakan berbicara sekarang...")
         print(f"   💡 Tip: Bacakan narasi yang sama untuk hasil terbaik")
         
-        frames = []
+        # Buffer sampel dialokasikan sekali di awal
+        total_sampel = int(sample_rate * durasi)
+        buffer = np.empty(total_sampel, dtype=np.int16)
         
         # Hitung jumlah chunk yang dibutuhkan
-        total_chunks = int(sample_rate / CHUNK * durasi)
+        total_chunks = -(-total_sampel // CHUNK)
         
         # Progress bar sederhana
         for i in range(total_chunks):
-            data = stream.read(CHUNK, exception_on_overflow=False)
-            frames.append(data)
+            awal = i * CHUNK
+            jumlah = min(CHUNK, total_sampel - awal)
+            data = stream.read(jumlah, exception_on_overflow=False)
+            buffer[awal:awal + jumlah] = np.frombuffer(data, dtype=np.int16)
             
             # Progress indicator
-            progress = (i + 1) / total_chunks * 100
-            bars = int(progress / 5)
-            sys.stdout.write(f"\r   Progress: [{'█' * bars}{'░' * (20 - bars)}] {progress:.0f}%")
-            sys.stdout.flush()
+            if (i + 1) % PROGRESS_SETIAP == 0 or i + 1 == total_chunks:
+                progress = (i + 1) / total_chunks * 100
+                bars = int(progress / 5)
+                sys.stdout.write(f"\r   Progress: [{'█' * bars}{'░' * (20 - bars)}] {progress:.0f}%")
+                sys.stdout.flush()
         
         print(f"\n✅ Rekaman selesai!")
         
@@ -117,13 +170,8 @@ def rekam_audio(filename, durasi=10, sample_rate=16000):
         stream.stop_stream()
         stream.close()
         
-        # Simpan ke file WAV
-        wf = wave.open(filename, 'wb')
-        wf.setnchannels(CHANNELS)
-        wf.setsampwidth(p.get_sample_size(FORMAT))
-        wf.setframerate(sample_rate)
-        wf.writeframes(b''.join(frames))
-        wf.close()
+        # Simpan ke file WAV langsung dari buffer
+        sf.write(filename, buffer, sample_rate, subtype='PCM_16')
         
         print(f"   💾 Audio disimpan ke '{filename}'")
         
@@ -187,8 +235,8 @@ except Exception as e:
 try:
     print(f"\n🔧 Memproses audio untuk verifikasi...")
     
-    # Preprocess kedua file audio
-    enrollment_wav = preprocess_wav(Path("enrollment.wav"))
+    # Preprocess semua file audio
+    enrollment_wavs = [preprocess_wav(Path(f)) for f in file_enrollment]
     verification_wav = preprocess_wav(Path("verification.wav"))
     
     print("✅ Audio berhasil diproses!")
@@ -201,12 +249,19 @@ except Exception as e:
 try:
     print(f"\n🧬 Mengekstrak fitur suara (voice embeddings)...")
     
-    # Ekstrak embedding dari kedua audio
-    enrollment_embed = encoder.embed_utterance(enrollment_wav)
-    verification_embed = encoder.embed_utterance(verification_wav)
+    # Ekstrak embedding, lalu normalisasi (L2) agar dot product = cosine similarity
+    # Semua referensi ditumpuk jadi satu matriks (satu baris per file enrollment)
+    enrollment_embeds = np.stack(
+        [encoder.embed_utterance(w) for w in enrollment_wavs]
+    ).astype(np.float32)
+    enrollment_embeds /= np.linalg.norm(enrollment_embeds, axis=1, keepdims=True)
+    
+    verification_embed = encoder.embed_utterance(verification_wav).astype(np.float32)
+    verification_embed /= np.linalg.norm(verification_embed)
     
     print(f"✅ Embedding berhasil diekstrak!")
-    print(f"   Dimensi embedding: {enrollment_embed.shape[0]}D")
+    print(f"   Dimensi embedding: {enrollment_embeds.shape[1]}D")
+    print(f"   Jumlah referensi: {enrollment_embeds.shape[0]}")
 
 except Exception as e:
     print(f"\n❌ ERROR saat ekstraksi embedding: {e}")
@@ -216,8 +271,9 @@ except Exception as e:
 try:
     print(f"\n📊 Menghitung kesamaan suara...")
     
-    # Cosine similarity antara dua embedding
-    similarity = np.dot(enrollment_embed, verification_embed)
+    # Cosine similarity ke semua referensi sekaligus (satu perkalian matriks-vektor)
+    scores = enrollment_embeds @ verification_embed
+    similarity = float(scores.max())
     
     # Threshold untuk menentukan apakah sama atau beda
     threshold = 0.70
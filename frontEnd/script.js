@@ -192,11 +192,16 @@ document.addEventListener("DOMContentLoaded", () => {
       initialTranscriptionElem.textContent = data.initial_transcription;
       finalSoundElem.textContent = data.natural_text;
 
+      // Token hanya dikirim oleh main_normal.py; backend lain mengabaikan query ini
+      const tokenQuery = data.token
+        ? `?token=${encodeURIComponent(data.token)}`
+        : "";
+
       // Ambil file audio secara paralel
       const [summaryAudioResponse, transcriptionAudioResponse] =
         await Promise.all([
-          fetch(`${API_BASE_URL}/get_response_audio`),
-          fetch(`${API_BASE_URL}/get_transcription_audio`),
+          fetch(`${API_BASE_URL}/get_response_audio${tokenQuery}`),
+          fetch(`${API_BASE_URL}/get_transcription_audio${tokenQuery}`),
         ]);
 
       if (summaryAudioResponse.ok) {